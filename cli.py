@@ -1,153 +1,248 @@
-import argparse
+import functools
 import os
 import sqlite3
-import subprocess
-import tempfile
+import sys
+from contextlib import contextmanager
 from pathlib import Path
-from typing import List, Optional, Tuple
-
-from prompt_toolkit import prompt
-from prompt_toolkit.completion import FuzzyWordCompleter
+from types import SimpleNamespace
+from typing import TYPE_CHECKING, Iterator, List, Optional
+
+if TYPE_CHECKING:
+    import argparse
+
+_SQL_GET_JOURNAL_MODE = "PRAGMA journal_mode"
+_SQL_SET_JOURNAL_MODE = "PRAGMA journal_mode=WAL"
+# Per-connection settings; unlike journal_mode these do not persist.
+_SQL_PRAGMAS = '''
+    PRAGMA synchronous=NORMAL;
+    PRAGMA temp_store=MEMORY;
+    PRAGMA busy_timeout=5000;
+    PRAGMA cache_size=-2000;
+'''
+_SQL_OPTIMIZE = "PRAGMA optimize"
+# Bump _SCHEMA_VERSION whenever _SQL_INIT_SCHEMA changes so existing
+# databases pick up the new statements on their next open.
+_SCHEMA_VERSION = 1
+_SQL_GET_SCHEMA_VERSION = "PRAGMA user_version"
+# Creates the schema and the root node. Only run when user_version is
+# behind, so steady-state startup never takes the write lock.
+_SQL_INIT_SCHEMA = f'''
+    BEGIN IMMEDIATE;
+    CREATE TABLE IF NOT EXISTS wip (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        parent INTEGER,
+        path TEXT NOT NULL,
+        name TEXT NOT NULL,
+        notes TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        archived_at TIMESTAMP,
+        current BOOLEAN DEFAULT 0,
+        FOREIGN KEY (parent) REFERENCES wip (id)
+    );
+    CREATE INDEX IF NOT EXISTS idx_current ON wip(id) WHERE current = 1;
+    CREATE INDEX IF NOT EXISTS idx_wip_path ON wip(path)
+    WHERE archived_at IS NULL;
+    CREATE INDEX IF NOT EXISTS idx_wip_parent_name ON wip(parent, name)
+    WHERE archived_at IS NULL;
+    INSERT INTO wip (path, name, current)
+    SELECT '/', 'Root', 1
+    WHERE NOT EXISTS (SELECT 1 FROM wip WHERE parent IS NULL);
+    PRAGMA user_version = {_SCHEMA_VERSION};
+    COMMIT;
+'''
+_SQL_GET_CURRENT = (
+    "SELECT id, path, name, notes, parent FROM wip WHERE current = 1")
+# Only the old and new current rows are touched: the first via
+# idx_current, the second via the primary key.
+_SQL_SET_CURRENT = '''
+    UPDATE wip SET current = (id = :id)
+    WHERE id = :id OR id IN (SELECT id FROM wip WHERE current = 1)
+'''
+_SQL_INSERT_NODE = '''
+    INSERT INTO wip (parent, path, name, notes) VALUES (?, ?, ?, ?)
+    RETURNING id, path, name, notes, parent
+'''
+# Ids of a node and all of its active descendants, walked inside SQLite
+# via idx_wip_parent_name.
+_SQL_SUBTREE = '''
+    WITH RECURSIVE subtree(id) AS (
+        SELECT id FROM wip WHERE id = ?
+        UNION ALL
+        SELECT w.id FROM wip w JOIN subtree s ON w.parent = s.id
+        WHERE w.archived_at IS NULL
+    )
+'''
+_SQL_GET_DESCENDANTS = _SQL_SUBTREE + '''
+    SELECT id, path, name, notes FROM wip
+    WHERE id IN subtree AND archived_at IS NULL
+    ORDER BY path
+'''
+_SQL_ARCHIVE_SUBTREE = _SQL_SUBTREE + '''
+    UPDATE wip SET archived_at = CURRENT_TIMESTAMP
+    WHERE id IN subtree
+'''
+_SQL_GET_NODE = "SELECT id, path, name, notes, parent FROM wip WHERE id = ?"
+_SQL_UPDATE_NOTES = "UPDATE wip SET notes = ? WHERE id = ?"
+_SQL_GET_CHILDREN = '''
+    SELECT id, name
+    FROM wip
+    WHERE parent = ? AND archived_at IS NULL
+    ORDER BY name
+'''
+# Served in order straight from idx_wip_path, no sort step.
+_SQL_GET_ALL_PATHS = (
+    "SELECT path FROM wip WHERE archived_at IS NULL ORDER BY path")
+_SQL_GET_ID_BY_PATH = (
+    "SELECT id FROM wip WHERE path = ? AND archived_at IS NULL")
 
 
 class WIPTracker:
 
     def __init__(self):
         self.db_file = Path(__file__).parent / "wip.db"
-        self.conn = sqlite3.connect(str(self.db_file))
+        # All queries use the module-level _SQL_* constants so repeated
+        # executions hit the connection's prepared-statement cache.
+        # isolation_level=None disables implicit transactions; multi-statement
+        # writes go through _transaction() instead.
+        self.conn = sqlite3.connect(str(self.db_file),
+                                    cached_statements=128,
+                                    isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        if self.conn.execute(_SQL_GET_JOURNAL_MODE).fetchone()[0] != "wal":
+            self.conn.execute(_SQL_SET_JOURNAL_MODE)
+        self.conn.executescript(_SQL_PRAGMAS)
+        version = self.conn.execute(_SQL_GET_SCHEMA_VERSION).fetchone()[0]
+        if version < _SCHEMA_VERSION:
+            self.conn.executescript(_SQL_INIT_SCHEMA)
         self.cursor = self.conn.cursor()
-        self.create_table()
-        self.ensure_root_node()
-
-    def create_table(self):
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS wip (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                parent INTEGER,
-                path TEXT NOT NULL,
-                name TEXT NOT NULL,
-                notes TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                archived_at TIMESTAMP,
-                current BOOLEAN DEFAULT 0,
-                FOREIGN KEY (parent) REFERENCES wip (id)
-            )
-        ''')
-        self.conn.commit()
-
-    def ensure_root_node(self):
-        self.cursor.execute("SELECT id FROM wip WHERE parent IS NULL")
-        if not self.cursor.fetchone():
-            self.cursor.execute(
-                "INSERT INTO wip (path, name, current) VALUES ('/', 'Root', 1)"
-            )
-            self.conn.commit()
-
-    def get_current_node(self) -> Tuple[int, str, str, Optional[str]]:
-        self.cursor.execute(
-            "SELECT id, path, name, notes FROM wip WHERE current = 1")
-        return self.cursor.fetchone()
-
-    def set_current_node(self, node_id: int):
-        self.cursor.execute("UPDATE wip SET current = 0")
-        self.cursor.execute("UPDATE wip SET current = 1 WHERE id = ?",
-                            (node_id, ))
-        self.conn.commit()
+        # Row of the current node, reused until something changes it.
+        self._cur: Optional[sqlite3.Row] = None
 
-    def push(self, name: str, notes: Optional[str] = None) -> None:
-        current_id, current_path, _, _ = self.get_current_node()
-        new_path = os.path.join(current_path, name).replace('\\', '/')
-        self.cursor.execute(
-            "INSERT INTO wip (parent, path, name, notes) VALUES (?, ?, ?, ?)",
-            (current_id, new_path, name, notes))
-        new_id = self.cursor.lastrowid
-        self.set_current_node(new_id)
-        self.conn.commit()
+    @contextmanager
+    def _transaction(self) -> Iterator[None]:
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            # SQLite may already have rolled back on its own (e.g. on
+            # SQLITE_FULL); a second ROLLBACK would mask the real error.
+            if self.conn.in_transaction:
+                self.conn.execute("ROLLBACK")
+            self._cur = None
+            raise
+        self.conn.execute("COMMIT")
+
+    def get_current_node(self) -> sqlite3.Row:
+        if self._cur is None:
+            self.cursor.execute(_SQL_GET_CURRENT)
+            self._cur = self.cursor.fetchone()
+        return self._cur
+
+    def set_current_node(self,
+                         node_id: int,
+                         row: Optional[sqlite3.Row] = None):
+        self.cursor.execute(_SQL_SET_CURRENT, {"id": node_id})
+        self._cur = row
 
-    def pop(self) -> str:
-        current_id, current_path, current_name, _ = self.get_current_node()
+    def push(self, name: str, notes: Optional[str] = None) -> None:
+        current = self.get_current_node()
+        current_path = current["path"]
+        # Stored paths always use '/' and only the root ends with one.
         if current_path == '/':
-            return "Cannot delete root node"
-
-        self.cursor.execute("SELECT parent FROM wip WHERE id = ?",
-                            (current_id, ))
-        parent_id = self.cursor.fetchone()[0]
-
-        # Archive the current node
-        self.cursor.execute(
-            "UPDATE wip SET archived_at = CURRENT_TIMESTAMP WHERE id = ?",
-            (current_id, ))
-
-        self.set_current_node(parent_id)
-        self.conn.commit()
+            new_path = '/' + name
+        else:
+            new_path = current_path + '/' + name
+        with self._transaction():
+            self.cursor.execute(_SQL_INSERT_NODE,
+                                (current["id"], new_path, name, notes))
+            new_node = self.cursor.fetchone()
+            self.set_current_node(new_node["id"], new_node)
 
-        self.cursor.execute("SELECT path, name FROM wip WHERE id = ?",
-                            (parent_id, ))
-        parent_path, parent_name = self.cursor.fetchone()
-        return f"Deleted node and moved to parent: {parent_path} ({parent_name})"
+    def pop(self) -> str:
+        # One write transaction covers the read, the archive and the move
+        # so a concurrent command cannot change the current node midway.
+        with self._transaction():
+            current = self.get_current_node()
+            if current["path"] == '/':
+                return "Cannot delete root node"
+
+            # Archive the current node and everything below it
+            self.cursor.execute(_SQL_ARCHIVE_SUBTREE, (current["id"], ))
+            self.cursor.execute(_SQL_GET_NODE, (current["parent"], ))
+            parent = self.cursor.fetchone()
+            self.set_current_node(parent["id"], parent)
+        return ("Deleted node and moved to parent: "
+                f"{parent['path']} ({parent['name']})")
+
+    def descendants(self, node_id: int) -> List[sqlite3.Row]:
+        self.cursor.execute(_SQL_GET_DESCENDANTS, (node_id, ))
+        return self.cursor.fetchall()
 
     def current_info(self) -> str:
-        _, path, name, notes = self.get_current_node()
-        return f"Current WIP: {name}\nPath: {path}\nNotes: {notes or 'None'}"
-
-    def edit_note(self, new_note: Optional[str] = None) -> None:
-        current_id, _, _, current_notes = self.get_current_node()
+        current = self.get_current_node()
+        return (f"Current WIP: {current['name']}\n"
+                f"Path: {current['path']}\n"
+                f"Notes: {current['notes'] or 'None'}")
+
+    def edit_note(self, new_note: Optional[str] = None) -> str:
+        current = self.get_current_node()
+        current_notes = current["notes"]
         if new_note is not None:
             updated_notes = f"{current_notes or ''}\n{new_note}".strip()
         else:
+            import subprocess
+            import tempfile
+
             editor = os.environ.get('EDITOR', 'vi')
-            with tempfile.NamedTemporaryFile(mode='w+',
-                                             suffix=".txt",
-                                             delete=False) as temp_file:
-                if current_notes:
-                    temp_file.write(current_notes)
-                temp_file.close()
-                subprocess.call([editor, temp_file.name])
-                with open(temp_file.name, 'r') as updated_file:
+            fd, temp_path = tempfile.mkstemp(suffix=".txt")
+            try:
+                with os.fdopen(fd, 'w') as temp_file:
+                    temp_file.write(current_notes or '')
+                subprocess.call([editor, temp_path])
+                # Re-open by name rather than reusing the handle: editors
+                # that save by renaming a new file into place would leave
+                # it pointing at the old contents.
+                with open(temp_path, 'r') as updated_file:
                     updated_notes = updated_file.read().strip()
-            os.unlink(temp_file.name)
+            finally:
+                os.unlink(temp_path)
+
+        if updated_notes == (current_notes or ''):
+            return "Notes unchanged"
 
-        self.cursor.execute("UPDATE wip SET notes = ? WHERE id = ?",
-                            (updated_notes, current_id))
-        self.conn.commit()
+        self.cursor.execute(_SQL_UPDATE_NOTES,
+                            (updated_notes, current["id"]))
+        self._cur = None
+        return "Note updated successfully"
 
     def up(self) -> str:
-        current_id, current_path, _, _ = self.get_current_node()
-        if current_path == '/':
+        current = self.get_current_node()
+        if current["path"] == '/':
             return "Already at root node"
 
-        self.cursor.execute("SELECT parent FROM wip WHERE id = ?",
-                            (current_id, ))
-        parent_id = self.cursor.fetchone()[0]
-        self.set_current_node(parent_id)
+        self.set_current_node(current["parent"])
         return self.current_info()
 
     def down(self) -> str:
-        current_id, _, _, _ = self.get_current_node()
-        self.cursor.execute(
-            """
-            SELECT id, name 
-            FROM wip 
-            WHERE parent = ? AND archived_at IS NULL
-            ORDER BY name
-        """, (current_id, ))
+        current = self.get_current_node()
+        self.cursor.execute(_SQL_GET_CHILDREN, (current["id"], ))
         children = self.cursor.fetchall()
 
         if not children:
             return "No children nodes"
         elif len(children) == 1:
-            self.set_current_node(children[0][0])
+            self.set_current_node(children[0]["id"])
             return self.current_info()
         else:
             print("Select a child node:")
-            for i, (_, child_name) in enumerate(children, 1):
-                print(f"{i}. {child_name}")
+            for i, child in enumerate(children, 1):
+                print(f"{i}. {child['name']}")
 
             while True:
                 try:
                     choice = int(input("Enter the number of your choice: "))
                     if 1 <= choice <= len(children):
-                        self.set_current_node(children[choice - 1][0])
+                        self.set_current_node(children[choice - 1]["id"])
                         return self.current_info()
                     else:
                         print("Invalid choice. Please try again.")
@@ -159,15 +254,23 @@ class WIPTracker:
                     return "\n...cancelled"
 
     def get_all_paths(self) -> List[str]:
-        self.cursor.execute("SELECT path FROM wip WHERE archived_at IS NULL")
-        return [row[0] for row in self.cursor.fetchall()]
+        self.cursor.execute(_SQL_GET_ALL_PATHS)
+        return [row["path"] for row in self.cursor.fetchall()]
 
     def switch(self) -> str:
+        # prompt_toolkit is slow to import and only needed here.
+        from prompt_toolkit import prompt
+        from prompt_toolkit.completion import FuzzyWordCompleter
+
         all_paths = self.get_all_paths()
         path_completer = FuzzyWordCompleter(all_paths)
 
         try:
-            selected_path = prompt("Switch to: ", completer=path_completer)
+            # Matching runs off the input thread so typing stays responsive
+            # on large trees.
+            selected_path = prompt("Switch to: ",
+                                   completer=path_completer,
+                                   complete_in_thread=True)
         except KeyboardInterrupt:
             return "...cancelled"
         except EOFError:
@@ -176,21 +279,39 @@ class WIPTracker:
         if not selected_path:
             return "No path selected"
 
-        self.cursor.execute("SELECT id FROM wip WHERE path = ?",
-                            (selected_path, ))
+        self.cursor.execute(_SQL_GET_ID_BY_PATH, (selected_path, ))
         result = self.cursor.fetchone()
         if result:
-            self.set_current_node(result[0])
+            self.set_current_node(result["id"])
             return f"Switched to: {self.current_info()}"
         else:
             return f"Error: Could not find node with path {selected_path}"
 
-    def __del__(self):
-        if hasattr(self, 'conn'):
+    def __enter__(self) -> "WIPTracker":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        try:
+            self.conn.execute(_SQL_OPTIMIZE)
+        except sqlite3.OperationalError:
+            # optimize may need the write lock; it is only a hint, so a
+            # busy database should not fail the command or mask its error.
+            pass
+        finally:
             self.conn.close()
 
 
-def main() -> None:
+# Commands that take no arguments; these are dispatched without argparse.
+_SIMPLE_COMMANDS = {"current", "pop", "up", "down", "path", "switch"}
+
+
+@functools.lru_cache(maxsize=1)
+def build_parser() -> "argparse.ArgumentParser":
+    import argparse
+
     parser = argparse.ArgumentParser(description="wip-cli")
     subparsers = parser.add_subparsers(dest="command", required=True)
 
@@ -222,28 +343,34 @@ def main() -> None:
     subparsers.add_parser("switch",
                           help="Interactively switch to a WIP based on path")
 
-    args: argparse.Namespace = parser.parse_args()
-
-    tracker = WIPTracker()
-
-    if args.command == "push":
-        tracker.push(args.name, args.notes)
-        print(f"Created new WIP: {args.name}")
-    elif args.command == "current":
-        print(tracker.current_info())
-    elif args.command == "pop":
-        print(tracker.pop())
-    elif args.command == "note":
-        tracker.edit_note(args.note)
-        print("Note updated successfully")
-    elif args.command == "up":
-        print(tracker.up())
-    elif args.command == "down":
-        print(tracker.down())
-    elif args.command == "path":
-        print(tracker.get_current_node()[1])
-    elif args.command == "switch":
-        print(tracker.switch())
+    return parser
+
+
+def main() -> None:
+    argv = sys.argv[1:]
+    if len(argv) == 1 and argv[0] in _SIMPLE_COMMANDS:
+        args = SimpleNamespace(command=argv[0])
+    else:
+        args = build_parser().parse_args(argv)
+
+    with WIPTracker() as tracker:
+        if args.command == "push":
+            tracker.push(args.name, args.notes)
+            print(f"Created new WIP: {args.name}")
+        elif args.command == "current":
+            print(tracker.current_info())
+        elif args.command == "pop":
+            print(tracker.pop())
+        elif args.command == "note":
+            print(tracker.edit_note(args.note))
+        elif args.command == "up":
+            print(tracker.up())
+        elif args.command == "down":
+            print(tracker.down())
+        elif args.command == "path":
+            print(tracker.get_current_node()["path"])
+        elif args.command == "switch":
+            print(tracker.switch())
 
 
 if __name__ == "__main__":